@@ -1,19 +1,69 @@
-import json
+import argparse
+import hashlib
 import os
+import random
+import time
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 
 import faiss
 import numpy as np
+import orjson
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+import tiktoken
 from dotenv import load_dotenv
 from openai import OpenAI
 
 DATA_DIR = Path("data")
-CHUNKS_PATH = DATA_DIR / "chunks.jsonl"
+CHUNKS_PATH = DATA_DIR / "chunks.parquet"
+LEGACY_CHUNKS_PATH = DATA_DIR / "chunks.jsonl"
 INDEX_DIR = Path("vector_store")
 INDEX_DIR.mkdir(parents=True, exist_ok=True)
+INDEX_PATH = INDEX_DIR / "index.faiss"
+META_PATH = INDEX_DIR / "meta.json"
+# Chunk ids as one contiguous fixed-width bytes array; FAISS label i maps to ids[i] (see lookup_ids).
+IDS_PATH = INDEX_DIR / "ids.npy"
+# Indexes larger than this are memory-mapped on load rather than copied into RAM. FAISS maps
+# IVF inverted lists with IO_FLAG_MMAP and flat code storage (SQ, HNSW+SQ) with IO_FLAG_MMAP_IFC;
+# each flag is a no-op for the other layout, and they cannot be combined.
+MMAP_THRESHOLD_BYTES = 1 << 30
+# All tiers (SQfp16 scan, HNSW+SQ, IVF-PQ with the default parallel_mode) parallelize search over
+# queries, so extra OpenMP threads do nothing for a single query beyond spin-up overhead:
+# single-query callers run on one thread, batch callers pass nthreads and send >= 16 queries per search().
+NTHREADS_HINT = 1
+QUERY_BATCH_HINT = 16
+# Normalized embeddings keyed by content hash, so rebuilds only embed new/changed chunks.
+EMBED_CACHE_VECTORS = INDEX_DIR / "embed_cache.npy"
+EMBED_CACHE_KEYS = INDEX_DIR / "embed_cache_keys.npy"
+CACHE_COPY_ROWS = 16_384  # rows per cache-to-X copy (~100 MB at 1536 dims)
 
-EMBED_MODEL = "text-embedding-3-small"  # 1536 dims;
-BATCH = 128
+EMBED_MODEL = "text-embedding-3-small"
+EMBED_DIM = 1536  # output size of EMBED_MODEL
+# Pack requests by token count, staying under the API's per-request limits.
+MAX_BATCH_TOKENS = 240_000
+MAX_BATCH_INPUTS = 2048
+TOKEN_ENCODING = "cl100k_base"
+EMBED_WORKERS = 8  # concurrent embedding requests
+EMBED_MAX_RETRIES = 5  # the OpenAI client backs off on 429s, honoring Retry-After
+EMBED_JITTER_S = 0.05  # random delay before each request so workers don't burst tokens-per-minute together
+
+# Vectors are unit-norm after normalize_L2, so fp16 codes lose next to nothing while
+# halving index size and scan bandwidth ("SQ8" would quarter it, at a small recall cost).
+SQ_CODEC = "SQfp16"
+
+# Exact search is fine for small corpora; past this size switch to an HNSW graph.
+HNSW_THRESHOLD = 50_000
+HNSW_M = 32
+HNSW_EF_CONSTRUCTION = 200
+HNSW_EF_SEARCH = 64
+
+# Very large corpora: OPQ-rotated IVF with 32-byte PQ codes to keep the index in memory.
+PQ_THRESHOLD = 1_000_000
+PQ_FACTORY = "OPQ32,IVF4096,PQ32"
+PQ_NPROBE = 32
+PQ_TRAIN_SAMPLE = 200_000
 
 
 def embed_texts(client: OpenAI, texts: list[str]) -> np.ndarray:
@@ -22,46 +72,212 @@ def embed_texts(client: OpenAI, texts: list[str]) -> np.ndarray:
     return np.array(vecs, dtype="float32")
 
 
+def embed_input(section: str | None, text: str) -> str:
+    """Prefix the chunk text with its section path so headings inform the embedding."""
+    return f"{section}\n\n{text}" if section else text
+
+
+def read_chunks() -> tuple[list[str], list[str], list[int]]:
+    """Return (chunk ids, embedding inputs, token counts) from chunks.parquet, reading only the needed columns."""
+    table = pq.read_table(CHUNKS_PATH, columns=["id", "section", "text", "n_tokens"])
+    # Same result as embed_input(), computed in Arrow's C++ kernels; null sections are skipped.
+    # The kernel needs one string type for all arguments, so normalize everything to large_string.
+    section = table["section"].cast(pa.large_string())
+    text = table["text"].cast(pa.large_string())
+    sep = pa.scalar("\n\n", pa.large_string())
+    inputs = pc.binary_join_element_wise(section, text, sep, null_handling="skip")
+    return table["id"].to_pylist(), inputs.to_pylist(), table["n_tokens"].to_pylist()
+
+
+def read_chunks_legacy() -> tuple[list[str], list[str], list[int]]:
+    """Return (chunk ids, embedding inputs, token counts) from chunks.jsonl."""
+    ids = []
+    texts = []
+    n_tokens = []
+    encoding = None
+    with LEGACY_CHUNKS_PATH.open("rb") as f:
+        for line in f:
+            rec = orjson.loads(line)
+            ids.append(rec["id"])
+            texts.append(embed_input(rec.get("section"), rec["text"]))
+            n = rec.get("n_tokens")
+            if n is None:
+                # Chunks written before token counts were cached.
+                encoding = encoding or tiktoken.get_encoding(TOKEN_ENCODING)
+                n = len(encoding.encode(texts[-1]))
+            n_tokens.append(n)
+    return ids, texts, n_tokens
+
+
+def cache_key(text: str) -> bytes:
+    """Content hash of an embedding input; the model is included so switching models invalidates."""
+    return hashlib.sha256(f"{EMBED_MODEL}\n{text}".encode("utf-8")).hexdigest().encode("ascii")
+
+
+def load_embed_cache() -> tuple[dict[bytes, int], np.ndarray | None]:
+    """Return (key -> row, vectors) from the previous build; vectors are memory-mapped."""
+    if not (EMBED_CACHE_VECTORS.exists() and EMBED_CACHE_KEYS.exists()):
+        return {}, None
+    keys = np.load(EMBED_CACHE_KEYS)
+    vectors = np.load(EMBED_CACHE_VECTORS, mmap_mode="r")
+    return {k: row for row, k in enumerate(keys.tolist())}, vectors
+
+
+def save_embed_cache(keys: list[bytes], X: np.ndarray):
+    """Persist vectors for the current chunks only; entries for removed chunks are dropped."""
+    # Write to temp files and swap, so a memory-mapped previous cache is never truncated in place.
+    for path, arr in ((EMBED_CACHE_KEYS, np.array(keys, dtype="S64")), (EMBED_CACHE_VECTORS, X)):
+        tmp_path = path.with_suffix(".tmp.npy")
+        np.save(tmp_path, arr)
+        os.replace(tmp_path, path)
+
+
+def pack_batches(rows: list[int], n_tokens: list[int]) -> list[list[int]]:
+    """Greedily group rows into batches bounded by total tokens and input count."""
+    batches = []
+    batch, batch_tokens = [], 0
+    for row in rows:
+        n = n_tokens[row]
+        if batch and (batch_tokens + n > MAX_BATCH_TOKENS or len(batch) >= MAX_BATCH_INPUTS):
+            batches.append(batch)
+            batch, batch_tokens = [], 0
+        batch.append(row)
+        batch_tokens += n
+    if batch:
+        batches.append(batch)
+    return batches
+
+
+def build_faiss_index(X: np.ndarray) -> tuple[faiss.Index, dict]:
+    """
+    Pick an index type for the corpus size; return the index and search params for meta.
+    The index is wrapped in IndexIDMap with row numbers as ids, which index into ids.npy.
+    """
+    n, d = X.shape
+    if n > PQ_THRESHOLD:
+        index = faiss.index_factory(d, PQ_FACTORY, faiss.METRIC_INNER_PRODUCT)
+        # Train on a random subsample; codebooks do not need the full corpus.
+        rng = np.random.default_rng(0)
+        sample = rng.choice(n, size=min(n, PQ_TRAIN_SAMPLE), replace=False)
+        index.train(X[np.sort(sample)])
+        faiss.extract_index_ivf(index).nprobe = PQ_NPROBE
+        params = {"index_type": PQ_FACTORY, "nprobe": PQ_NPROBE}
+    elif n <= HNSW_THRESHOLD:
+        # Exact inner product (= cosine after normalize) over scalar-quantized codes.
+        index = faiss.index_factory(d, SQ_CODEC, faiss.METRIC_INNER_PRODUCT)
+        index.train(X)
+        params = {"index_type": SQ_CODEC}
+    else:
+        factory = f"HNSW{HNSW_M},{SQ_CODEC}"
+        index = faiss.index_factory(d, factory, faiss.METRIC_INNER_PRODUCT)
+        index.hnsw.efConstruction = HNSW_EF_CONSTRUCTION
+        index.hnsw.efSearch = HNSW_EF_SEARCH
+        index.train(X)
+        params = {"index_type": factory, "efSearch": HNSW_EF_SEARCH}
+
+    # IndexIDMap rather than IndexIDMap2: labels are only mapped forward, so the reverse
+    # id -> row hash map (rebuilt in RAM on every load) would be dead weight.
+    index = faiss.IndexIDMap(index)
+    index.add_with_ids(X, np.arange(n, dtype=np.int64))
+    return index, params
+
+
+def mmap_flag(index_type: str) -> str:
+    """Name of the faiss IO flag that memory-maps the bulk of this index type's data."""
+    return "IO_FLAG_MMAP" if index_type == PQ_FACTORY else "IO_FLAG_MMAP_IFC"
+
+
+def load_index(nthreads: int | None = None) -> tuple[faiss.Index, dict, np.ndarray]:
+    """
+    Load the index, its meta and chunk ids; large indexes are memory-mapped read-only so only
+    touched pages hit RAM. Map search labels back to chunk ids with lookup_ids(ids, I).
+    Sets the FAISS OpenMP thread count to `nthreads`, defaulting to the hint recorded at build time.
+    """
+    meta = orjson.loads(META_PATH.read_bytes())
+    faiss.omp_set_num_threads(nthreads or meta.get("nthreads_hint", NTHREADS_HINT))
+    flag_name = meta.get("mmap_flag")
+    flags = getattr(faiss, flag_name) | faiss.IO_FLAG_READ_ONLY if flag_name else 0
+    ids = np.load(IDS_PATH, mmap_mode="r")
+    return faiss.read_index(str(INDEX_PATH), flags), meta, ids
+
+
+def lookup_ids(ids: np.ndarray, I: np.ndarray) -> list[list[str | None]]:
+    """
+    Map FAISS search labels to chunk ids, row for row with the distances.
+    HNSW and IVF return -1 when they find fewer than k hits; those map to None, not ids[-1].
+    """
+    return [[ids[j].decode("utf-8") if j >= 0 else None for j in row] for row in I]
+
+
 def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--legacy", action="store_true", help="read chunks.jsonl instead of chunks.parquet")
+    args = ap.parse_args()
+
     load_dotenv()
 
-    client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
-    if not CHUNKS_PATH.exists():
-        raise FileNotFoundError("Run chunk_docs.py first: data/chunks.jsonl not found")
+    client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"), max_retries=EMBED_MAX_RETRIES)
+    chunks_path = LEGACY_CHUNKS_PATH if args.legacy else CHUNKS_PATH
+    if not chunks_path.exists():
+        raise FileNotFoundError(f"Run chunk_docs.py first: {chunks_path} not found")
 
-    texts = []
+    # 1) Read chunks
+    ids, texts, n_tokens = read_chunks_legacy() if args.legacy else read_chunks()
 
-    # 1) Read chunks.jsonl
-    with CHUNKS_PATH.open("r", encoding="utf-8") as f:
-        for line in f:
-            rec = json.loads(line)
-            # TODO: Optionally embed section name as well.
-            texts.append(rec["text"])
-
-    # 2) Embed in batches
-    all_vecs = []
-    for i in range(0, len(texts), BATCH):
-        batch = texts[i:i + BATCH]
-        vecs = embed_texts(client, batch)
-        all_vecs.append(vecs)
-    X = np.vstack(all_vecs)  # shape: (N, D)
-
-    # 3) Build FAISS index (L2 with normalized vectors ≈ cosine)
-    # normalize for cosine similarity
-    faiss.normalize_L2(X)
-    d = X.shape[1]
-    index = faiss.IndexFlatIP(d)  # inner product after normalize = cosine
-    index.add(X)
-
-    # 4) Save index + metadata
-    faiss.write_index(index, str(INDEX_DIR / "index.faiss"))
+    # 2) Reuse cached embeddings; only chunks whose content changed need the API.
+    keys = [cache_key(t) for t in texts]
+    cache_rows, cache_vecs = load_embed_cache()
+    hit_rows = [i for i, k in enumerate(keys) if k in cache_rows]
+    miss_rows = [i for i, k in enumerate(keys) if k not in cache_rows]
+    # Identical inputs (shared boilerplate, repeated snippets) are embedded once, then copied.
+    first_row = {}
+    for i in miss_rows:
+        first_row.setdefault(keys[i], i)
+    unique_rows = list(first_row.values())
+    dup_rows = [i for i in miss_rows if first_row[keys[i]] != i]
+    print(f"Embedding cache: {len(hit_rows)} hits, {len(unique_rows)} to embed, {len(dup_rows)} duplicates")
+
+    # Preallocate once and fill rows in place instead of stacking per-batch arrays.
+    X = np.empty((len(texts), EMBED_DIM), dtype="float32")  # shape: (N, D)
+    # Copy cache hits in bounded slices so the gathered temporary never approaches the size of X.
+    for start in range(0, len(hit_rows), CACHE_COPY_ROWS):
+        rows = hit_rows[start:start + CACHE_COPY_ROWS]
+        X[rows] = cache_vecs[[cache_rows[keys[i]] for i in rows]]
+
+    # 3) Embed misses in batches; requests are latency-bound, so keep several in flight.
+    # Each batch owns a disjoint set of rows, so workers write into X without locking.
+    # Vectors are normalized per batch (in place) so an un-normalized copy of X never exists.
+    def embed_rows(rows: list[int]):
+        time.sleep(random.uniform(0, EMBED_JITTER_S))
+        vecs = embed_texts(client, [texts[i] for i in rows])
+        faiss.normalize_L2(vecs)  # inner product on unit vectors = cosine
+        X[rows] = vecs
+
+    with ThreadPoolExecutor(max_workers=EMBED_WORKERS) as pool:
+        list(pool.map(embed_rows, pack_batches(unique_rows, n_tokens)))  # list() re-raises worker errors
+    if dup_rows:
+        X[dup_rows] = X[[first_row[keys[i]] for i in dup_rows]]
+    del cache_vecs  # release the memory map before the cache files are replaced
+    save_embed_cache(keys, X)
+
+    # 4) Build FAISS index (rows of X are already unit-norm)
+    index, index_params = build_faiss_index(X)
+
+    # 5) Save index + metadata
+    faiss.write_index(index, str(INDEX_PATH))
+    np.save(IDS_PATH, np.array([i.encode("utf-8") for i in ids]))  # dtype S<max id length>
+    index_bytes = INDEX_PATH.stat().st_size
     meta = {
         "model": EMBED_MODEL,
-        "ntotal": index.ntotal
+        "ntotal": index.ntotal,
+        **index_params,
+        "index_bytes": index_bytes,
+        # Name of the faiss IO flag readers OR with IO_FLAG_READ_ONLY (see load_index); None = load into RAM.
+        "mmap_flag": mmap_flag(index_params["index_type"]) if index_bytes > MMAP_THRESHOLD_BYTES else None,
+        "nthreads_hint": NTHREADS_HINT,
+        "query_batch_hint": QUERY_BATCH_HINT,
     }
-    meta_path = INDEX_DIR / "meta.json"
-    with meta_path.open("w", encoding="utf-8") as f:
-        json.dump(meta, f, ensure_ascii=False, indent=2)
+    META_PATH.write_bytes(orjson.dumps(meta, option=orjson.OPT_INDENT_2))
 
     print(f"✅ Built FAISS index with {index.ntotal} vectors @ {INDEX_DIR}")
 
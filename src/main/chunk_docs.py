@@ -1,7 +1,17 @@
-import json
-import re
+import argparse
+import multiprocessing
+import os
+import threading
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
 from pathlib import Path
+from queue import Queue
 import frontmatter
+import orjson
+import pyarrow as pa
+import pyarrow.parquet as pq
+import tiktoken
 
 from langchain.text_splitter import MarkdownHeaderTextSplitter, RecursiveCharacterTextSplitter
 
@@ -9,41 +19,58 @@ from langchain.text_splitter import MarkdownHeaderTextSplitter, RecursiveCharact
 DATA_DIR = Path("data")
 RAW_DIR = DATA_DIR / "raw"
 MANIFEST_PATH = RAW_DIR / "manifest.jsonl"
-OUT_PATH = DATA_DIR / "chunks.jsonl"
+OUT_PATH = DATA_DIR / "chunks.parquet"
+LEGACY_OUT_PATH = DATA_DIR / "chunks.jsonl"
+WRITE_BUFFER_SIZE = 1 << 20  # coalesce per-chunk writes into ~1 MB syscalls
+
+# Columnar layout: field names are stored once, and readers can load only the columns they need.
+CHUNK_SCHEMA = pa.schema([
+    ("id", pa.string()),
+    ("rel", pa.string()),
+    ("source", pa.string()),
+    ("section", pa.string()),
+    ("chunk_index", pa.int32()),
+    ("text", pa.large_string()),
+    ("n_tokens", pa.int32()),
+])
+PARQUET_ROW_GROUP_SIZE = 50_000
 
 # Heading-aware first, then chunk by length
 HEADERS_TO_SPLIT = [("#", "h1"), ("##", "h2"), ("###", "h3"), ("####", "h4")]
 CHUNK_SIZE = 1200
 CHUNK_OVERLAP = 150
+CHUNK_WORKERS = os.cpu_count() or 1  # cpu_count() may return None
+# Pipeline bounds: files read ahead of the splitters, and files being split but not yet written.
+READ_AHEAD = 64
+MAX_IN_FLIGHT = 4 * CHUNK_WORKERS
+TOKEN_ENCODING = "cl100k_base"  # tokenizer of the OpenAI embedding models
 
+# Built once at import, so each worker process reuses its own splitters across files.
 header_splitter = MarkdownHeaderTextSplitter(headers_to_split_on=HEADERS_TO_SPLIT)
 char_splitter = RecursiveCharacterTextSplitter(
     chunk_size=CHUNK_SIZE,
     chunk_overlap=CHUNK_OVERLAP,
 )
+encoding = tiktoken.get_encoding(TOKEN_ENCODING)
 
 
-def read_md_clean(path: Path):
-    post = frontmatter.load(path)
+def read_md_clean(raw: str):
+    post = frontmatter.loads(raw)
     return post.content, post.metadata.get("source", None)
 
 
 def clean_text(s: str) -> str:
     # Collapse excessive whitespace but preserve code blocks fencing
-    # (simple and safe for MVP)
-    return re.sub(r"\s+", " ", s).strip()
+    # (simple and safe for MVP). str.split() splits on whitespace runs in C, no regex needed.
+    return " ".join(s.split())
 
 
-def chunk_one_file(rel: str, source_url: str):
-    """Yield chunk records for a single markdown file identified by rel path."""
-    md_path = RAW_DIR / rel
-    if not md_path.exists():
-        print(f"⚠️ Missing file: {md_path}")
-        return
-
-    text, front_meta = read_md_clean(md_path)
+def chunk_one_file(rel: str, source_url: str, raw: str) -> list[dict]:
+    """Return chunk records for the contents of a single markdown file identified by rel path."""
+    text, front_meta = read_md_clean(raw)
     header_docs = header_splitter.split_text(text)
 
+    records = []
     chunk_idx = 0
     for hd in header_docs:
         # Build a section path like "H1 > H2 > H3"
@@ -55,40 +82,128 @@ def chunk_one_file(rel: str, source_url: str):
             body = clean_text(piece)
             if not body:
                 continue
-            yield {
+            records.append({
                 "id": f"{rel}::{chunk_idx:04d}",  # deterministic ID
                 "rel": rel,
                 "source": source_url,
                 "section": section,
                 "chunk_index": chunk_idx,
                 "text": body,
-            }
+                # Counted on the exact embedding input (see build_index.embed_input) so batch packing is exact.
+                "n_tokens": len(encoding.encode(f"{section}\n\n{body}" if section else body)),
+            })
             chunk_idx += 1
+    return records
 
 
-def main():
-    if not MANIFEST_PATH.exists():
-        raise FileNotFoundError("manifest.jsonl not found. Run fetch first.")
+def chunk_entry(item: tuple[str, str, str | None]) -> list[dict]:
+    """Process-pool friendly wrapper around chunk_one_file."""
+    rel, source_url, raw = item
+    return chunk_one_file(rel, source_url, raw) if raw is not None else []
 
-    OUT_PATH.parent.mkdir(parents=True, exist_ok=True)
-    tmp_path = OUT_PATH.with_suffix(".tmp.jsonl")
 
-    total_chunks = 0
-    with MANIFEST_PATH.open("r", encoding="utf-8") as mf, tmp_path.open("w", encoding="utf-8") as out:
+def read_files(entries, files: Queue, errors: list):
+    """Reader stage: load markdown for each manifest entry into `files`, then a None sentinel."""
+    try:
+        for rel, source_url in entries:
+            md_path = RAW_DIR / rel
+            if not md_path.exists():
+                print(f"⚠️ Missing file: {md_path}")
+                files.put((rel, source_url, None))
+                continue
+            files.put((rel, source_url, md_path.read_text(encoding="utf-8")))
+    except Exception as e:
+        errors.append(e)
+    finally:
+        files.put(None)
+
+
+def iter_manifest():
+    """Yield (rel, source_url) pairs from manifest.jsonl."""
+    with MANIFEST_PATH.open("rb") as mf:
         for line in mf:
             line = line.strip()
             if not line:
                 continue
-            entry = json.loads(line)
-            rel = entry["rel"]
-            src = entry.get("source_url")
+            entry = orjson.loads(line)
+            yield entry["rel"], entry.get("source_url")
+
+
+@contextmanager
+def jsonl_writer(path: Path):
+    """Yield a write(records) callable appending records to a JSONL file."""
+    with path.open("wb", buffering=WRITE_BUFFER_SIZE) as out:
+        def write(records: list[dict]):
+            for rec in records:
+                out.write(orjson.dumps(rec) + b"\n")
+
+        yield write
 
-            for rec in chunk_one_file(rel, src):
-                out.write(json.dumps(rec, ensure_ascii=False) + "\n")
-                total_chunks += 1
 
-    tmp_path.rename(OUT_PATH)
-    print(f"✅ Saved {total_chunks} chunks → {OUT_PATH.resolve()}")
+@contextmanager
+def parquet_writer(path: Path):
+    """Yield a write(records) callable buffering records into Parquet row groups."""
+    pending = []
+    with pq.ParquetWriter(path, CHUNK_SCHEMA, compression="zstd") as writer:
+        def write(records: list[dict]):
+            pending.extend(records)
+            if len(pending) >= PARQUET_ROW_GROUP_SIZE:
+                writer.write_table(pa.Table.from_pylist(pending, schema=CHUNK_SCHEMA))
+                pending.clear()
+
+        yield write
+        if pending:
+            writer.write_table(pa.Table.from_pylist(pending, schema=CHUNK_SCHEMA))
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--legacy", action="store_true", help="write chunks.jsonl instead of chunks.parquet")
+    args = ap.parse_args()
+
+    if not MANIFEST_PATH.exists():
+        raise FileNotFoundError("manifest.jsonl not found. Run fetch first.")
+
+    out_path = LEGACY_OUT_PATH if args.legacy else OUT_PATH
+    out_path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = out_path.with_suffix(".tmp" + out_path.suffix)
+    open_writer = jsonl_writer if args.legacy else parquet_writer
+
+    # Three overlapping stages: a reader thread loads files, worker processes parse + split them
+    # (CPU-bound, independent per file), and the main thread writes records.
+    files = Queue(maxsize=READ_AHEAD)
+    read_errors = []
+    reader = threading.Thread(target=read_files, args=(iter_manifest(), files, read_errors), daemon=True)
+    reader.start()
+
+    total_chunks = 0
+    # The reader thread is already running, so workers must not be fork()ed from this process:
+    # a child could inherit a lock held by that thread and deadlock. forkserver children are
+    # forked from a clean single-threaded server instead.
+    mp_context = multiprocessing.get_context("forkserver")
+    with (
+        ProcessPoolExecutor(max_workers=CHUNK_WORKERS, mp_context=mp_context) as pool,
+        open_writer(tmp_path) as write,
+    ):
+        # Futures queue up in manifest order; writing only from the head keeps output deterministic.
+        in_flight = deque()
+        while (item := files.get()) is not None:
+            in_flight.append(pool.submit(chunk_entry, item))
+            while len(in_flight) >= MAX_IN_FLIGHT or (in_flight and in_flight[0].done()):
+                records = in_flight.popleft().result()
+                write(records)
+                total_chunks += len(records)
+        for fut in in_flight:
+            records = fut.result()
+            write(records)
+            total_chunks += len(records)
+
+    reader.join()
+    if read_errors:
+        raise read_errors[0]
+
+    tmp_path.rename(out_path)
+    print(f"✅ Saved {total_chunks} chunks → {out_path.resolve()}")
 
 
 if __name__ == "__main__":
@@ -2,8 +2,8 @@ import argparse
 import base64
 import json
 import os
-import shutil
 import sys
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from pathlib import Path
 
 import github.Auth
@@ -13,43 +13,82 @@ from github import Github, GithubException
 DEFAULT_REPO = "langchain-ai/langgraph"
 DEFAULT_BRANCH = "main"
 DEFAULT_OUT_DIR = "data/raw"
+DEFAULT_DOCS_DIR = "docs"
+DEFAULT_WORKERS = 16
+TREE_ETAG_FILE = ".tree_etag"
 
 load_dotenv()
 
 
-def write_file_and_metainfo(dst: Path, content: bytes):
-    """
-    Write file only if contents changed (based on sha256).
-    Returns True if written, False if unchanged.
-    """
+def load_manifest(manifest_path: Path) -> dict[str, dict]:
+    """Previous manifest entries keyed by rel path (empty on first run)."""
+    if not manifest_path.exists():
+        return {}
+    with manifest_path.open("r", encoding="utf-8") as f:
+        entries = [json.loads(line) for line in f if line.strip()]
+    return {entry["rel"]: entry for entry in entries}
+
+
+def write_file(dst: Path, content: bytes):
+    """Write a fetched blob; only blobs whose git sha changed (or that are missing locally) get here."""
     dst.parent.mkdir(parents=True, exist_ok=True)
     dst.write_bytes(content)
 
 
+def load_tree_etag(etag_path: Path, key: str) -> str | None:
+    """ETag of the last tree listing, if it was recorded for the same repo/branch/docs dir."""
+    if not etag_path.exists():
+        return None
+    state = json.loads(etag_path.read_text(encoding="utf-8"))
+    return state["etag"] if state.get("key") == key else None
+
+
+def fetch_tree(gh: Github, repo_name: str, branch: str, etag: str | None) -> tuple[list[dict] | None, str | None]:
+    """
+    List the recursive git tree, sending If-None-Match when an ETag is known.
+    Returns (None, etag) on 304 Not Modified, which does not count against the rate limit.
+    """
+    headers = {"If-None-Match": etag} if etag else None
+    status, resp_headers, body = gh.requester.requestJson(
+        "GET", f"/repos/{repo_name}/git/trees/{branch}", parameters={"recursive": "1"}, headers=headers
+    )
+    if status == 304:
+        return None, etag
+    if status >= 400:
+        raise GithubException(status, body, resp_headers)
+    return json.loads(body)["tree"], resp_headers.get("etag")
+
+
+def fetch_blob(repo, sha: str) -> bytes:
+    """Fetch a single git blob by sha and return its decoded bytes."""
+    blob = repo.get_git_blob(sha)
+    if blob.encoding == "base64":
+        return base64.b64decode(blob.content)
+    return blob.content.encode("utf-8", errors="ignore")
+
+
 def main():
     ap = argparse.ArgumentParser()
     ap.add_argument("--repo", default=DEFAULT_REPO, help="GitHub repo in org/name format")
     ap.add_argument("--branch", default=DEFAULT_BRANCH, help="branch to fetch")
     ap.add_argument("--out", default=DEFAULT_OUT_DIR, help="output directory")
+    ap.add_argument("--docs-dir", default=DEFAULT_DOCS_DIR, help="docs directory inside the repo")
+    ap.add_argument("--workers", type=int, default=DEFAULT_WORKERS, help="concurrent blob fetches")
     args = ap.parse_args()
 
-    # Remove everything before checkout.
+    # Keep the previous checkout so unchanged files are left untouched; stale files are pruned below.
     out_dir = Path(args.out)
-    if out_dir.exists():
-        shutil.rmtree(out_dir)
-    out_dir.mkdir(parents=True)
+    out_dir.mkdir(parents=True, exist_ok=True)
+    manifest_path = out_dir / "manifest.jsonl"
+    previous = load_manifest(manifest_path)
 
     token = os.getenv("GITHUB_TOKEN")
     if not token:
         print("WARNING: GITHUB_TOKEN is not set. You may hit low rate limits for anonymous access.", file=sys.stderr)
 
-    gh = Github(auth=github.Auth.Token(token), per_page=100) if token else Github(per_page=100)
-
-    try:
-        repo = gh.get_repo(args.repo)
-    except GithubException as e:
-        print(f"Failed to access repo {args.repo}: {e}", file=sys.stderr)
-        sys.exit(1)
+    # Match the HTTP connection pool to the number of fetch workers.
+    gh_kwargs = {"per_page": 100, "pool_size": args.workers}
+    gh = Github(auth=github.Auth.Token(token), **gh_kwargs) if token else Github(**gh_kwargs)
 
     docs_prefix = args.docs_dir.strip("/") + "/"
     md_suffixes = (".md", ".mdx")
@@ -57,18 +96,34 @@ def main():
     total = 0
 
     # Efficient way: list the entire tree (recursive) once, then filter paths.
+    # Conditional on the last ETag, so an unchanged branch costs a single 304 and nothing else.
+    etag_path = out_dir / TREE_ETAG_FILE
+    etag_key = f"{args.repo}@{args.branch}:{docs_prefix}"
+    checkout_intact = previous and all((out_dir / Path(rel).with_suffix(".md")).exists() for rel in previous)
+    etag = load_tree_etag(etag_path, etag_key) if checkout_intact else None
     try:
-        tree = repo.get_git_tree(args.branch, recursive=True).tree
+        tree, new_etag = fetch_tree(gh, args.repo, args.branch, etag)
     except GithubException as e:
         print(f"Failed to fetch git tree for branch '{args.branch}': {e}", file=sys.stderr)
         sys.exit(2)
+    if tree is None:
+        print(f"Tree unchanged since last fetch; {len(previous)} files up to date in {out_dir.resolve()}")
+        return
+
+    try:
+        repo = gh.get_repo(args.repo)
+    except GithubException as e:
+        print(f"Failed to access repo {args.repo}: {e}", file=sys.stderr)
+        sys.exit(1)
 
     manifest = []
+    pending = []
+    live = set()
     for item in tree:
         # We only care about blobs (files) under docs/ with .md/.mdx
-        if item.type != "blob":
+        if item["type"] != "blob":
             continue
-        path = item.path  # e.g. "docs/tutorials/agents.md"
+        path = item["path"]  # e.g. "docs/tutorials/agents.md"
         if not path.startswith(docs_prefix):
             continue
         if not path.lower().endswith(md_suffixes):
@@ -76,36 +131,62 @@ def main():
 
         rel = Path(path[len(docs_prefix):])  # e.g. tutorials/agents.md
         dst = out_dir / rel.with_suffix(".md")  # normalize .mdx -> .md if desired
-
         gh_url = f"https://github.com/{args.repo}/blob/{args.branch}/{path}"
+        live.add(dst)
 
-        try:
-            content_file = repo.get_contents(path, ref=args.branch)
-            if content_file.encoding == "base64":
-                raw = base64.b64decode(content_file.content)
-            else:
-                raw = content_file.decoded_content or content_file.content.encode("utf-8", errors="ignore")
-        except GithubException as e:
-            print(f"Skip {path}: {e}", file=sys.stderr)
+        # Same blob sha as last run: the local copy is current, no need to download it.
+        prev = previous.get(str(rel))
+        if prev and prev.get("sha") == item["sha"] and dst.exists():
+            total += 1
+            manifest.append({**prev, "source_url": gh_url})
             continue
 
-        # Prepend source URL if missing
-        write_file_and_metainfo(dst, raw)
-        print(f"✓ updated: {rel}")
-
-        total += 1
-        manifest.append({"rel": str(rel), "source_url": gh_url})
+        # Tree items already carry the blob sha, so there is no need for get_contents().
+        pending.append((path, rel, item["sha"], gh_url))
+
+    # Blob fetches are pure network latency: issue them concurrently.
+    # PyGithub's default retry policy honors Retry-After / rate-limit reset headers.
+    failed = 0
+    with ThreadPoolExecutor(max_workers=args.workers) as pool:
+        futures = {pool.submit(fetch_blob, repo, sha): (path, rel, sha, gh_url) for path, rel, sha, gh_url in pending}
+        for fut in as_completed(futures):
+            path, rel, sha, gh_url = futures[fut]
+            try:
+                raw = fut.result()
+            except GithubException as e:
+                print(f"Skip {path}: {e}", file=sys.stderr)
+                failed += 1
+                continue
+
+            dst = out_dir / rel.with_suffix(".md")  # normalize .mdx -> .md if desired
+            write_file(dst, raw)
+            print(f"✓ updated: {rel}")
+
+            total += 1
+            manifest.append({"rel": str(rel), "source_url": gh_url, "sha": sha})
+
+    # Drop files that no longer exist upstream.
+    for stale in out_dir.rglob("*.md"):
+        if stale not in live:
+            stale.unlink()
+            print(f"✗ removed: {stale.relative_to(out_dir)}")
+
+    # Completion order is arbitrary; keep the manifest deterministic.
+    manifest.sort(key=lambda entry: entry["rel"])
 
     print(f"\nDone. Files scanned: {total}")
     print(f"Output dir: {out_dir.resolve()}")
 
-    manifest_path = out_dir / "manifest.jsonl"
-    manifest_path.parent.mkdir(parents=True, exist_ok=True)
-
     with manifest_path.open("w", encoding="utf-8") as f:
         for entry in manifest:
             f.write(json.dumps(entry, ensure_ascii=False) + "\n")
 
+    # Only trust the ETag once every file of this tree is on disk; otherwise re-list next run.
+    if new_etag and not failed:
+        etag_path.write_text(json.dumps({"key": etag_key, "etag": new_etag}), encoding="utf-8")
+    elif etag_path.exists():
+        etag_path.unlink()
+
 
 if __name__ == "__main__":
     main()